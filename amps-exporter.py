@@ -1,7 +1,15 @@
 from prometheus_client import start_http_server
 from prometheus_client.core import GaugeMetricFamily, REGISTRY
-import requests
+import signal
+import threading
 import time
+import urllib3
+
+try:
+    import orjson
+except ImportError:
+    # the standard library parser accepts bytes as well, just slower
+    import json as orjson
 
 
 # Descriptions for every metric we collect below
@@ -76,14 +84,141 @@ METRIC_DOCS = {
     }
 }
 
+# METRIC_DOCS flattened for a single lookup, ex.: ('/amps/host/memory', 'free')
+_METRIC_DOCS_FLAT = {
+    (path, metric): documentation
+    for path, docs in METRIC_DOCS.items()
+    for metric, documentation in docs.items()
+}
 
-def get_stats(host):
-    """
-    This method collects stats from AMPS at the moment of the scrape event
-    from Prometheus.  It can also handle all the required authentication
-    or custom HTTP headers, if needed.
-    """
-    return requests.get(host + '/amps.json').json()
+# "all" aggregate entries are skipped in favor of the individual entries
+DEFAULT_SKIP_IDS = frozenset({'all'})
+
+# Every metric group collected on each scrape, in order, as
+# (path, metrics[, label_key[, skip_ids]]) where the optional fields default
+# to those of AMPSCollector.append_metric_group
+COLLECT_SPEC = (
+    # Baseline Host Metrics (/amps/host)
+    #
+    # Typically, a monitoring system will capture, at a minimum, the
+    # following metrics about host-level performance. Since these related to
+    # the underlying system rather than AMPS itself, many sites already
+    # collect the equivalent of these statistics by default.
+    #
+    # This is not a complete list of statisics available for the host, but
+    # provides a starting point for developing your monitoring plan.
+
+    # Memory metrics
+    ('/amps/host/memory', ('free', 'in_use', 'swap_free', 'swap_total')),
+
+    # Networking metrics (for each interface)
+    ('/amps/host/network', ('bytes_in', 'bytes_out')),
+
+    # File system capacity metrics (for each partition)
+    ('/amps/host/disks', ('file_system_free_percent',)),
+
+    # CPU metrics (for each CPU core)
+    ('/amps/host/cpus', ('iowait_percent', 'idle_percent')),
+
+    # Baseline Message Flow Metrics
+    #
+    # The following metrics monitor overall message flow to the instance.
+    #
+    # This is not a complete list of statisics available for message flow,
+    # but provides a starting point for developing your monitoring plan.
+    (
+        '/amps/instance/processors',
+        (
+            'messages_received_per_sec',
+            'denied_reads',
+            'denied_writes',
+            'last_active',
+            'throttle_count'
+        )
+    ),
+
+    # SOW Topic Traffic Metrics
+    #
+    # The following metrics monitor message flow for specific topics in the
+    # SOW (including Topics, Views, ConflatedTopics, and all replication
+    # models for Queues).
+    #
+    # Depending on your appliction, of course, a given metric may not be
+    # relevant. (For example, if an application only uses queues, then the
+    # “update” metrics would not be relevant, since a message can be added to
+    # the queue or removed from the queue, but cannot be modified while in
+    # the queue.)
+    (
+        '/amps/instance/sow',
+        (
+            'inserts_per_sec',
+            'updates_per_sec',
+            'deletes_per_sec',
+            'queries_per_sec',
+            'insert_count',
+            'delete_count',
+            'update_count'
+        )
+    ),
+
+    # View-Specific Metrics
+    #
+    # If your application uses views, the following minimal metrics monitor
+    # traffic for a view. These should be monitored in addition to the
+    # general SOW topic metrics above.
+    ('/amps/instance/views', ('queue_depth',)),
+
+    # Queue-Specific Metrics
+    #
+    # If your application uses queues, the following minimal metrics monitor
+    # traffic for a queue. These should be monitored in addition to the
+    # general SOW topic metrics above.
+    (
+        '/amps/instance/queues',
+        (
+            'seconds_behind',
+            'queue_depth',
+
+            # watch these extra metrics in grafana for replicated queues
+            'transferred_in',
+            'transferred_out',
+            'owned'
+        )
+    ),
+
+    # Replication Destination Metrics
+    #
+    # The following metrics monitor traffic for a queue. These should be
+    # monitored in addition to the general topic metrics above.
+    (
+        '/amps/instance/replication',
+        ('is_connected', 'seconds_behind', 'messages_out_per_sec')
+    ),
+
+    # Application Connection Metrics
+    #
+    # The following metrics monitor network activity for a client connection.
+    (
+        '/amps/instance/clients',
+        (
+            'transport_rx_queue',
+            'transport_tx_queue',
+            'bytes_in_per_sec',
+            'bytes_out_per_sec',
+            'queue_depth_out',
+            'queue_max_latency'
+        )
+    )
+)
+
+# Prometheus metric name prefix per path, ex.: /amps/host/memory -> amps_host_memory_
+_METRIC_NAME_BASES = {path: path[1:].replace('/', '_') + '_' for path, *_ in COLLECT_SPEC}
+
+# keys to follow for each path, ex.: /amps/host/memory -> ('amps', 'host', 'memory')
+_PATH_KEYS = {path: tuple(path.split('/')[1:]) for path, *_ in COLLECT_SPEC}
+
+# single label tuple per metric, ex.: in_use -> ('in_use',)
+_METRIC_LABELS = {metric: (metric,) for _, metrics, *_ in COLLECT_SPEC for metric in metrics}
 
 
 def get_value(amps, path):
@@ -92,234 +227,134 @@ def get_value(amps, path):
     by following the path of the value.
     """
     current_value = amps
-    for key in path.split('/')[1:]:
+    for key in _PATH_KEYS[path]:
         current_value = current_value[key]
 
     return current_value
 
 
-def generate_metric_group(stats, path, metrics, label_key='id', skip_ids=['all']):
-    """
-    This function generates a group of gauges per each metric collection.
-    Example can be a gauge that tracks 'bytes_in' metric an array of network
-    interfaces.
-
-    If the metric is not of an array type, (say, /amps/host/memory/in_use) the
-    gauge will track a single value from dictionary that contains this metric.
-    """
-    # get a list of metric group objects say, /amps/host/disks objects
-    group_entries = get_value(stats, path)
-
-    metric_name_base = path[1:].replace('/', '_') + '_'
-    is_list = isinstance(group_entries, list)
-
-    for metric in metrics:
-        # create a gauge for each metric, ex.: /amps/host/network/{id}/bytes_in
-        gauge = GaugeMetricFamily(
-            metric_name_base + metric,
-            METRIC_DOCS.get(path, {}).get(metric, 'No description available'),
-            labels=[metric]
-        )
-
-        # populate the gauge
-        if is_list:
-            for entry in group_entries:
-                entry_id = entry[label_key]
-
-                # skip entries that we don't need, for example "all" aggregates
-                if skip_ids and entry_id in skip_ids:
-                    continue
-
-                # adding a metric, say ['eth0'], value for 'bytes_in` key
-                gauge.add_metric([entry_id], entry[metric])
-        else:
-            # adding a metric, say ['in_use'], value for 'in_use` key
-            gauge.add_metric([metric], group_entries[metric])
-
-        yield gauge
-
-
 # create a custom collector
 class AMPSCollector(object):
-    def __init__(self, host):
+    def __init__(self, host, stats_ttl=1.0):
         self.host = host
 
-    def collect_host_metrics(self, stats):
-        """
-        Baseline Host Metrics (/amps/host)
-
-        Typically, a monitoring system will capture, at a minimum, the
-        following metrics about host-level performance. Since these related to
-        the underlying system rather than AMPS itself, many sites already
-        collect the equivalent of these statistics by default.
-
-        This is not a complete list of statisics available for the host, but
-        provides a starting point for developing your monitoring plan.
-        """
-
-        # Memory metrics
-        yield from generate_metric_group(
-            stats,
-            path='/amps/host/memory',
-            metrics=['free', 'in_use', 'swap_free', 'swap_total']
-        )
-
-        # Networking metrics (for each interface)
-        yield from generate_metric_group(
-            stats,
-            path='/amps/host/network',
-            metrics=['bytes_in', 'bytes_out']
-        )
-
-        # File system capacity metrics (for each partition)
-        yield from generate_metric_group(
-            stats,
-            path='/amps/host/disks',
-            metrics=['file_system_free_percent']
-        )
-
-        # CPU metrics (for each CPU core)
-        yield from generate_metric_group(
-            stats,
-            path='/amps/host/cpus',
-            metrics=['iowait_percent', 'idle_percent']
+        # adjacent scrapes within stats_ttl seconds share one AMPS request
+        self.stats_ttl = stats_ttl
+        self._stats_cache = None
+        self._stats_ts = 0.0
+        self._stats_lock = threading.Lock()
+
+        # keep the connection to AMPS alive between scrapes, urllib3 is used
+        # directly since none of the requests session machinery is needed here.
+        # Like requests, failed requests are not retried but redirects are
+        # followed. Proxy environment variables and .netrc are not consulted.
+        self._http = urllib3.PoolManager(
+            maxsize=1,
+            timeout=urllib3.Timeout(connect=2, read=10),
+            retries=urllib3.Retry(total=None, connect=0, read=0, other=0, status=0, redirect=30)
         )
 
-    def collect_message_flow_metrics(self, stats):
+    def get_stats(self):
         """
-        Baseline Message Flow Metrics
-
-        The following metrics monitor overall message flow to the instance.
-
-        This is not a complete list of statisics available for message flow,
-        but provides a starting point for developing your monitoring plan.
+        This method collects stats from AMPS at the moment of the scrape event
+        from Prometheus.  It can also handle all the required authentication
+        or custom HTTP headers, if needed.
         """
+        # concurrent scrapes wait for the one in flight instead of hitting AMPS
+        with self._stats_lock:
+            if self._stats_cache is not None and time.monotonic() - self._stats_ts < self.stats_ttl:
+                return self._stats_cache
 
-        yield from generate_metric_group(
-            stats,
-            path='/amps/instance/processors',
-            metrics=[
-                'messages_received_per_sec',
-                'denied_reads',
-                'denied_writes',
-                'last_active',
-                'throttle_count'
-            ]
-        )
+            # the body is read in one go and the connection goes back to the pool
+            response = self._http.request('GET', self.host + '/amps.json')
+            if response.status != 200:
+                raise urllib3.exceptions.HTTPError(
+                    'AMPS returned HTTP %d for %s/amps.json' % (response.status, self.host)
+                )
 
-    def collect_sow_metrics(self, stats):
-        """
-        SOW Topic Traffic Metrics
+            # parse the raw bytes directly, orjson is much faster on large payloads
+            self._stats_cache = orjson.loads(response.data)
+            self._stats_ts = time.monotonic()
 
-        The following metrics monitor message flow for specific topics in the
-        SOW (including Topics, Views, ConflatedTopics, and all replication
-        models for Queues).
+            return self._stats_cache
 
-        Depending on your appliction, of course, a given metric may not be
-        relevant. (For example, if an application only uses queues, then the
-        “update” metrics would not be relevant, since a message can be added to
-        the queue or removed from the queue, but cannot be modified while in
-        the queue.)
+    def new_gauge(self, path, metric):
         """
-
-        yield from generate_metric_group(
-            stats,
-            path='/amps/instance/sow',
-            metrics=[
-                'inserts_per_sec',
-                'updates_per_sec',
-                'deletes_per_sec',
-                'queries_per_sec',
-                'insert_count',
-                'delete_count',
-                'update_count'
-            ]
+        This method returns an empty gauge for a metric, ex.:
+        /amps/host/network/{id}/bytes_in
+        """
+        return GaugeMetricFamily(
+            _METRIC_NAME_BASES[path] + metric,
+            _METRIC_DOCS_FLAT.get((path, metric), 'No description available'),
+            labels=_METRIC_LABELS[metric]
         )
 
-    def collect_views_metrics(self, stats):
+    def append_metric_group(self, out, stats, path, metrics, label_key='id', skip_ids=DEFAULT_SKIP_IDS):
         """
-        View-Specific Metrics
+        This method appends a group of gauges per each metric collection to out.
+        Example can be a gauge that tracks 'bytes_in' metric an array of network
+        interfaces.
 
-        If your application uses views, the following minimal metrics monitor
-        traffic for a view. These should be monitored in addition to the
-        general SOW topic metrics above.
+        If the metric is not of an array type, (say, /amps/host/memory/in_use) the
+        gauge will track a single value from dictionary that contains this metric.
         """
+        # get a list of metric group objects say, /amps/host/disks objects
+        group_entries = get_value(stats, path)
 
-        yield from generate_metric_group(
-            stats,
-            path='/amps/instance/views',
-            metrics=['queue_depth']
-        )
+        # pick the right way to populate gauges once for the whole group
+        if isinstance(group_entries, list):
+            # skip empty groups entirely, say no clients are connected
+            if not group_entries:
+                return
 
-    def collect_queue_metrics(self, stats):
-        """
-        Queue-Specific Metrics
+            self.append_list_metric_group(out, group_entries, path, metrics, label_key, skip_ids)
+        else:
+            self.append_dict_metric_group(out, group_entries, path, metrics)
 
-        If your application uses queues, the following minimal metrics monitor
-        traffic for a queue. These should be monitored in addition to the
-        general SOW topic metrics above.
+    def append_list_metric_group(self, out, group_entries, path, metrics, label_key, skip_ids):
+        """
+        This method appends a gauge per metric, each tracking the metric
+        across an array of entries, say network interfaces.
         """
+        for metric in metrics:
+            gauge = self.new_gauge(path, metric)
 
-        yield from generate_metric_group(
-            stats,
-            path='/amps/instance/queues',
-            metrics=[
-                'seconds_behind',
-                'queue_depth',
-
-                # watch these extra metrics in grafana for replicated queues
-                'transferred_in',
-                'transferred_out',
-                'owned'
-            ]
-        )
+            for entry in group_entries:
+                entry_id = entry[label_key]
 
-    def collect_replication_metrics(self, stats):
-        """
-        Replication Destination Metrics
+                # skip entries that we don't need, for example "all" aggregates
+                if skip_ids and entry_id in skip_ids:
+                    continue
 
-        The following metrics monitor traffic for a queue. These should be
-        monitored in addition to the general topic metrics above.
-        """
+                # adding a metric, say ('eth0',), value for 'bytes_in` key
+                gauge.add_metric((entry_id,), entry[metric])
 
-        yield from generate_metric_group(
-            stats,
-            path='/amps/instance/replication',
-            metrics=['is_connected', 'seconds_behind', 'messages_out_per_sec']
-        )
+            out.append(gauge)
 
-    def collect_application_connection_metrics(self, stats):
+    def append_dict_metric_group(self, out, group_entries, path, metrics):
         """
-        Application Connection Metrics
-
-        The following metrics monitor network activity for a client connection.
+        This method appends a gauge per metric, each tracking a single value
+        from the dictionary that contains the metric.
         """
+        for metric in metrics:
+            gauge = self.new_gauge(path, metric)
 
-        yield from generate_metric_group(
-            stats,
-            path='/amps/instance/clients',
-            metrics=[
-                'transport_rx_queue',
-                'transport_tx_queue',
-                'bytes_in_per_sec',
-                'bytes_out_per_sec',
-                'queue_depth_out',
-                'queue_max_latency'
-            ]
-        )
+            # adding a metric, say ('in_use',), value for 'in_use` key
+            gauge.add_metric(_METRIC_LABELS[metric], group_entries[metric])
+
+            out.append(gauge)
 
     def collect(self):
         # load currents stats from AMPS first
-        stats = get_stats(self.host)
+        stats = self.get_stats()
+
+        # collect groups of metrics into a single list, the registry only
+        # iterates over it once so there is no need for a generator chain
+        out = []
+        for path, metrics, *options in COLLECT_SPEC:
+            self.append_metric_group(out, stats, path, metrics, *options)
 
-        # collect and yield groups of metrics
-        yield from self.collect_host_metrics(stats)
-        yield from self.collect_message_flow_metrics(stats)
-        yield from self.collect_sow_metrics(stats)
-        yield from self.collect_views_metrics(stats)
-        yield from self.collect_queue_metrics(stats)
-        yield from self.collect_replication_metrics(stats)
-        yield from self.collect_application_connection_metrics(stats)
+        return out
 
 
 # register the AMPS collector with the Prometheus client
@@ -330,6 +365,8 @@ if __name__ == '__main__':
     # Start up the server to expose the metrics.
     start_http_server(8000)
 
-    # keep the server running
-    while True:
-        time.sleep(10)
+    # keep the server running until asked to stop, without waking up
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    stop.wait()